@@ -2,7 +2,7 @@ from imports import *
 import numpy as np
 
 
-def load_untrained_bert(dropout):
+def load_untrained_bert(dropout, use_checkpointing=False):
     """Load the untrained bert model"""
     config = transformers.BertConfig(
         hidden_dropout_prob=dropout,
@@ -10,10 +10,12 @@ def load_untrained_bert(dropout):
         num_labels=3,
     )
     model = transformers.BertForSequenceClassification(config)
-    return model
+    if use_checkpointing:
+        enable_checkpointing(model)
+    return compile_model(model)
 
 
-def load_pretrained_bert(dropout):
+def load_pretrained_bert(dropout, use_checkpointing=False):
     """Load the pretrained bert model"""
     model = transformers.BertForSequenceClassification.from_pretrained(
         # Use the 12-layer BERT model, with an uncased vocab.
@@ -24,10 +26,26 @@ def load_pretrained_bert(dropout):
         hidden_dropout_prob=dropout,
         attention_probs_dropout_prob=dropout
     )
-    return model
+    if use_checkpointing:
+        enable_checkpointing(model)
+    return compile_model(model)
+
+
+def compile_model(model):
+    """Compiles the model, capturing CUDA graphs to cut kernel launch overhead"""
+    # HF BERT branches on the padding mask, so graph breaks must be allowed
+    return torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+
+def enable_checkpointing(model):
+    """Recomputes the activations during the backward pass to trade compute for memory"""
+    # Non-reentrant checkpointing can be traced by dynamo, so it does not break the compiled graph
+    model.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs={"use_reentrant": False})
+    model.config.use_cache = False
 
 
-def train(model, train_dataloader, val_dataloader, optimizer, device, epochs, pretrained, dropout):
+def train(model, train_dataloader, val_dataloader, optimizer, device, epochs, pretrained, dropout, patience=None):
     """
     Trains the model for the chosen amount of epochs using early stopping
     Parameters:
@@ -35,11 +53,13 @@ def train(model, train_dataloader, val_dataloader, optimizer, device, epochs, pr
     model: transformers.BertForSequenceClassification
         The model to be trained
     train_dataloader: torch.utils.data.DataLoader
-        The dataloader for the training set
+        The dataloader for the training set, built with pin_memory=True so that
+        batches are copied to the device asynchronously
     val_dataloader: torch.utils.data.DataLoader
-        The dataloader for the validation set
+        The dataloader for the validation set, built with pin_memory=True
     optimizer: torch.optim
-        The optimizer to be used for training
+        The optimizer to be used for training, preferably AdamW constructed with
+        fused=True when training on a GPU. It is stepped eagerly through the GradScaler
     device: torch.device
         The device to be used for training
     epochs: int
@@ -48,81 +68,109 @@ def train(model, train_dataloader, val_dataloader, optimizer, device, epochs, pr
         Whether the model is pretrained or not
     dropout: float
         The dropout rate to be used
+    patience: int
+        The amount of epochs without improvement of the validation loss that is tolerated
+        before training stops, or None to always train for all epochs
     Returns:
     --------
     model: transformers.BertForSequenceClassification
         The trained model
     """
 
-    val_losses = []
+    best_val_loss, best_state, best_epoch = math.inf, None, 0
+    # Metrics are buffered per file and written once training has finished
+    log = defaultdict(list)
+    folder = get_evaluation_folder(pretrained, dropout)
+    # Scales the loss so that float16 gradients do not underflow
+    scaler = torch.amp.GradScaler("cuda", enabled=device.type == "cuda")
+
+    warm_up(model=model, dataloader=train_dataloader,
+            optimizer=optimizer, device=device)
 
     print("Starting training...")
     for epoch in range(epochs):
         print("Epoch number: " + str(epoch))
-        torch.save(model.state_dict(
-        ), f"{hydra.utils.get_original_cwd()}{os.path.sep}saves{os.path.sep}model_early_stopping_{str(epoch)}.pkl")
-
         train_acc, train_loss = training_step(
-            model=model, dataloader=train_dataloader, optimizer=optimizer, device=device)
+            model=model, dataloader=train_dataloader, optimizer=optimizer, device=device, scaler=scaler)
         val_acc, val_loss = validation_step(
             model=model, dataloader=val_dataloader, device=device)
-        val_losses.append(val_loss)
+
+        # Keep a copy of the parameters with the lowest validation loss in host memory,
+        # replacing a NaN best since no loss compares as lower than NaN
+        if best_state is None or math.isnan(best_val_loss) or val_loss < best_val_loss:
+            best_val_loss, best_epoch = val_loss, epoch
+            best_state = {k: v.detach().cpu().clone()
+                          for k, v in model.state_dict().items()}
 
         print(
             f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%')
         print(
             f'\tVal Loss: {val_loss:.3f} | Val Acc: {val_acc*100:.2f}%')
 
-        folder = f"{hydra.utils.get_original_cwd()}{os.path.sep}evaluation_data{os.path.sep}"
-        folder += "pretrained" if pretrained else "untrained"
-        folder = folder + \
-            f"{os.sep}normal" if dropout == 0 else folder + f"{os.sep}dropout"
+        log["train_accuracy.txt"].append(str(train_acc))
+        log["train_loss.txt"].append(str(train_loss))
+        log["val_accuracy.txt"].append(str(val_acc))
+        log["val_loss.txt"].append(str(val_loss))
 
-        write_to_file(folder, "train_accuracy.txt", str(train_acc))
-        write_to_file(folder, "train_loss.txt", str(train_loss))
-        write_to_file(folder, "val_accuracy.txt", str(val_acc))
-        write_to_file(folder, "val_loss.txt", str(val_loss))
+        if patience is not None and epoch - best_epoch > patience:
+            print(f"Stopping early, no improvement since epoch {best_epoch}")
+            break
 
     # Load the parameters of the model with the lowest validation loss
-    model.load_state_dict(torch.load(
-        f"{hydra.utils.get_original_cwd()}{os.path.sep}saves{os.path.sep}model_early_stopping_{str(np.argmin(val_losses))}.pkl"))
-    optimizer.params = torch.optim.AdamW(
-        model.parameters())
-
-    write_to_file(folder, "train_accuracy.txt", "\n")
-    write_to_file(folder, "train_loss.txt", "\n")
-    write_to_file(folder, "val_accuracy.txt", "\n")
-    write_to_file(folder, "val_loss.txt", "\n")
+    model.load_state_dict(best_state)
+
+    for file, values in log.items():
+        write_to_file(folder, file, " ".join(values) + " \n")
     print("Training finished")
 
     return model
 
 
-def training_step(model, dataloader, optimizer, device):
+def training_step(model, dataloader, optimizer, device, scaler):
     """
-    Trains the model based on one pass through all data
+    Trains the model based on one pass through all data using mixed precision
     Returns:
     --------
-    average_acc / len(train_dataloader): float
-        Average training accuracy over the different batches
+    correct / total: float
+        Training accuracy over all samples
     epoch_loss / len(train_dataloader): float
         Average training loss over the different batches
     """
-    epoch_loss = 0
-    average_acc = 0
+    # Kept on the device so that no synchronisation happens until the epoch ends
+    epoch_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
     model.train()
     for i, batch in enumerate(dataloader):
         optimizer.zero_grad()
-        batch = {k: v.to(device) for k, v in batch.items()}
-        predictions = model(**batch)
-        loss = predictions[0]
-        acc = accuracy_score(batch['labels'].cpu().detach().numpy(), np.argmax(
-            predictions[1].cpu().detach().numpy(), axis=1))
-        loss.backward()
-        optimizer.step()
-        epoch_loss += float(loss.item())
-        average_acc += float(acc)
-    return average_acc / len(dataloader), epoch_loss / len(dataloader)
+        batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+        with autocast(device):
+            predictions = model(**batch)
+            loss = predictions[0]
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        labels = batch['labels']
+        correct += (predictions[1].argmax(dim=1) == labels).sum()
+        total += labels.numel()
+        epoch_loss += loss.detach().float()
+    return correct.item() / total, epoch_loss.item() / len(dataloader)
+
+
+def warm_up(model, dataloader, optimizer, device):
+    """Runs one training and one inference pass so that compilation is not timed as part of the first epoch"""
+    model.train()
+    batch = {k: v.to(device, non_blocking=True) for k, v in next(iter(dataloader)).items()}
+    with autocast(device):
+        loss = model(**batch)[0]
+    loss.backward()
+    optimizer.zero_grad()
+
+    # Compile the evaluation graph under the same grad mode it is later run with
+    model.eval()
+    with torch.inference_mode():
+        with autocast(device):
+            model(**batch)
 
 
 def validation_step(model, dataloader, device):
@@ -130,27 +178,29 @@ def validation_step(model, dataloader, device):
     Evaluates the performance of the model on the validation set
 
     Returns:
-    (average_acc / len(val_dataloader)): float
-        Average validation accuracy over the different batches
+    (correct / total): float
+        Validation accuracy over all samples
     (epoch_loss / len(val_dataloader)): float
         Average validation loss over the different batches
     """
-    average_acc = 0
-    epoch_loss = 0
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    epoch_loss = torch.zeros((), device=device)
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         for i, batch in enumerate(dataloader):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            predictions = model(**batch)
-            loss = predictions[0]
-            acc = accuracy_score(batch['labels'].cpu().detach().numpy(), np.argmax(
-                predictions[1].cpu().detach().numpy(), axis=1))
-            average_acc += acc
-            epoch_loss += float(loss.item())
-    return (average_acc / len(dataloader)), (epoch_loss / len(dataloader))
-
-
-def evaluate(model, dataloader, device, pretrained, dropout, T=None):
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            with autocast(device):
+                predictions = model(**batch)
+                loss = predictions[0]
+            labels = batch['labels']
+            correct += (predictions[1].argmax(dim=1) == labels).sum()
+            total += labels.numel()
+            epoch_loss += loss.float()
+    return (correct.item() / total), (epoch_loss.item() / len(dataloader))
+
+
+def evaluate(model, dataloader, device, pretrained, dropout, T=None, T_chunk=None):
     """
     Makes evaluation steps corresponding to the amount of epochs and prints the loss and accuracy
     Parameters:
@@ -167,74 +217,130 @@ def evaluate(model, dataloader, device, pretrained, dropout, T=None):
         The dropout rate to be used
     T: int
         The amount of stochastic forward passes to make for MCD
+    T_chunk: int
+        The amount of stochastic forward passes to batch together, or None for all T
 
     Returns:
     --------
-    average_acc / len(dataloader): float
-        Average accuracy of the model predictions
+    correct / total: float
+        Accuracy of the model predictions over all samples
     """
     confusion_matrix = np.zeros((3, 3))
     confusion_matrix_mcd = np.zeros((3, 3))
-    average_acc = 0
-    average_acc_mcd = 0
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    correct_mcd = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    # The model is walked once; afterwards only the dropout layers are toggled per batch
+    model.eval()
+    dropout_layers = get_dropout_layers(model)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch in dataloader:
-            batch = {k: v.to(device) for k, v in batch.items()}
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            labels = batch['labels']
 
-            model.eval()
-            predictions = model(**batch)[1]
-            predictions = np.argmax(
-                predictions.cpu().detach().numpy(), axis=1)
-            confusion_matrix = update_confusion_matrix(
-                confusion_matrix, predictions, batch['labels'].cpu().detach().numpy())
-            batch_acc = accuracy_score(
-                batch['labels'].cpu().detach().numpy(), predictions)
-            average_acc += batch_acc
+            set_dropout(dropout_layers, False)
+            with autocast(device):
+                predictions = model(**batch)[1].argmax(dim=1)
+            correct += (predictions == labels).sum()
+            total += labels.numel()
+            to_host = [labels, predictions]
 
             # Use MCD if dropout is turned on
             if dropout > 0:
-                model = turn_on_dropout(model)
-                predictions_mcd = np.argmax(np.array(
-                    [model(**batch)[1].cpu().detach().numpy() for sample in range(T)]), axis=2)
-                predictions_mcd = np.array(
-                    stats.mode(predictions_mcd)[0])
+                set_dropout(dropout_layers, True)
+                with autocast(device):
+                    predictions_mcd = mcd_predictions(model, batch, T, T_chunk)
+                correct_mcd += (predictions_mcd == labels).sum()
+                to_host.append(predictions_mcd)
+
+            # A single device to host copy per batch for the confusion matrices
+            to_host = torch.stack(to_host).cpu().numpy()
+            confusion_matrix = update_confusion_matrix(
+                confusion_matrix, to_host[1], to_host[0])
+            if dropout > 0:
                 confusion_matrix_mcd = update_confusion_matrix(
-                    confusion_matrix_mcd, predictions_mcd.flatten(), batch['labels'].cpu().detach().numpy())
-                batch_acc_mcd = accuracy_score(
-                    batch['labels'].cpu().detach().numpy(), predictions_mcd.flatten())
-                average_acc_mcd += batch_acc_mcd
-
-    folder = f"{hydra.utils.get_original_cwd()}{os.path.sep}evaluation_data{os.path.sep}"
-    folder += "pretrained" if pretrained else "untrained"
-    folder = folder + \
-        f"{os.path.sep}normal" if dropout == 0 else folder + f"{os.sep}dropout"
-    write_to_file(folder, "test_accuracy.txt",
-                  f"{average_acc / len(dataloader)}\n")
+                    confusion_matrix_mcd, to_host[2], to_host[0])
+
+    folder = get_evaluation_folder(pretrained, dropout)
+    accuracy = correct.item() / total
+    write_to_file(folder, "test_accuracy.txt", f"{accuracy}\n")
     with open(f"{folder}{os.path.sep}confusion_matrix.txt", "ab") as f:
         np.savetxt(f, confusion_matrix, fmt='%d', footer="\n")
 
     if dropout > 0:
         write_to_file(folder, "test_accuracy_mcd.txt",
-                      f"{average_acc_mcd / len(dataloader)}\n")
+                      f"{correct_mcd.item() / total}\n")
         with open(f"{folder}{os.path.sep}confusion_matrix_mcd.txt", "ab") as f:
             np.savetxt(f, confusion_matrix_mcd, fmt='%d', footer="\n")
-    return (average_acc / len(dataloader))
+    return accuracy
+
+
+def mcd_predictions(model, batch, T, T_chunk=None):
+    """
+    Makes T stochastic forward passes on replicas of the batch, T_chunk at a time, and returns the majority vote
+    Parameters:
+    -----------
+    model: transformers.BertForSequenceClassification
+        The model with dropout turned on
+    batch: dict
+        The batch of inputs, already on the device
+    T: int
+        The amount of stochastic forward passes to make
+    T_chunk: int
+        The amount of replicas to put through the model in one forward pass, or None for all T
+
+    Returns:
+    --------
+    predictions: torch.Tensor
+        The most frequent predicted class of every example over the T passes, the smallest
+        class on ties as with scipy.stats.mode
+    """
+    T_chunk = T if T_chunk is None else T_chunk
+    batch_size = batch['labels'].shape[0]
+    predictions = []
+    for start in range(0, T, T_chunk):
+        t = min(T_chunk, T - start)
+        # Every replica gets its own dropout mask, as masks are sampled per element
+        replicated = {k: v.repeat(t, *([1] * (v.dim() - 1)))
+                      for k, v in batch.items() if k != 'labels'}
+        logits = model(**replicated).logits
+        predictions.append(logits.view(t, batch_size, -1).argmax(dim=2))
+    # argmax returns the first maximum, so ties go to the smallest class
+    votes = torch.nn.functional.one_hot(
+        torch.cat(predictions), num_classes=logits.shape[-1]).sum(dim=0)
+    return votes.argmax(dim=-1)
 
 
 def update_confusion_matrix(confusion_matrix, predictions, labels):
     """Updates the confusion matrix based on the predictions and the labels"""
-    for i in range(len(predictions)):
-        confusion_matrix[labels[i], predictions[i]] += 1
+    n_classes = confusion_matrix.shape[0]
+    confusion_matrix += np.bincount(labels.astype(np.int64) * n_classes + predictions.astype(np.int64),
+                                    minlength=n_classes * n_classes).reshape(n_classes, n_classes)
     return confusion_matrix
 
 
-def turn_on_dropout(model):
-    """Turns on dropout for all layers in the model"""
-    for m in model.modules():
-        if m.__class__.__name__.startswith('Dropout'):
-            m.training = True   # Turn on dropout
-    return model
+def get_dropout_layers(model):
+    """Returns all dropout layers in the model"""
+    return [m for m in model.modules() if isinstance(m, torch.nn.Dropout)]
+
+
+def set_dropout(dropout_layers, enabled):
+    """Turns dropout on or off for the given layers"""
+    for m in dropout_layers:
+        m.train(enabled)
+
+
+def autocast(device):
+    """Returns the float16 mixed precision context used for every forward pass, disabled on CPU"""
+    return torch.amp.autocast("cuda", dtype=torch.float16, enabled=device.type == "cuda")
+
+
+def get_evaluation_folder(pretrained, dropout):
+    """Returns the folder in which the evaluation data of the experiment is stored"""
+    return os.path.join(hydra.utils.get_original_cwd(), "evaluation_data",
+                        "pretrained" if pretrained else "untrained",
+                        "normal" if dropout == 0 else "dropout")
 
 
 def write_to_file(folder, file, text):
@@ -2,15 +2,15 @@ import datasets
 import torch
 import seaborn as sns
 import os
+import math
+from collections import defaultdict
 import matplotlib.pyplot as plt
 import nltk
 from sentence_transformers import SentenceTransformer
 from sklearn.decomposition import PCA
-from sklearn.metrics import accuracy_score
 import transformers
 import dill
 import hydra
 from omegaconf import DictConfig, OmegaConf
 import torchtext.data as data
-import pandas as pd
-from scipy import stats
\ No newline at end of file
+import pandas as pd
\ No newline at end of file
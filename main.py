@@ -8,6 +8,12 @@ SEED = 1815
 torch.manual_seed(SEED)
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
+
+# Allow TF32 tensor cores for the float32 matmuls and convolutions outside autocast
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 
@@ -43,20 +49,26 @@ def main(cfg: DictConfig):
     dataset = preprocess.generalise_dataset(dataset)
     dataset = preprocess.train_test_val_split(dataset, split)
     train_loader, val_loader, test_loader = preprocess.init_dataloaders(
-        dataset, cfg.batch_size)
+        dataset, cfg.batch_size, SEED)
 
     # Train and evaluate the model
     for run in range(cfg.runs):
         print(f"Run: {run}")
-        model = load_pretrained_bert(
-            cfg.dropout) if cfg.pretrained_bert else load_untrained_bert(cfg.dropout)
+        if cfg.pretrained_bert:
+            model = load_pretrained_bert(
+                cfg.dropout, cfg.gradient_checkpointing)
+        else:
+            model = load_untrained_bert(
+                cfg.dropout, cfg.gradient_checkpointing)
         model.to(device)
+        # The fused kernel updates all parameters at once, so the step is not compiled
         optimizer = torch.optim.AdamW(
-            params=model.parameters(), lr=cfg.lr)
+            params=model.parameters(), lr=cfg.lr, fused=device.type == "cuda")
         model = train(model=model, train_dataloader=train_loader, val_dataloader=val_loader, optimizer=optimizer,
-                      device=device, epochs=cfg.epochs, pretrained=cfg.pretrained_bert, dropout=cfg.dropout)
+                      device=device, epochs=cfg.epochs, pretrained=cfg.pretrained_bert, dropout=cfg.dropout,
+                      patience=cfg.patience)
         evaluate(model=model, dataloader=test_loader, device=device, pretrained=cfg.pretrained_bert,
-                 dropout=cfg.dropout, T=cfg.T)
+                 dropout=cfg.dropout, T=cfg.T, T_chunk=cfg.T_chunk)
 
 
 if __name__ == '__main__':
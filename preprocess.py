@@ -78,18 +78,32 @@ def tokenize(example):
     return tokenizer(example['text'], padding='max_length')
 
 
-def init_dataloaders(dataset, batch_size):
+def init_dataloaders(dataset, batch_size, seed):
     """Initialise the dataloaders for the dataset splits"""
     train_loader = torch.utils.data.DataLoader(
         dataset=dataset['train'],
-        batch_size=batch_size
+        batch_size=batch_size,
+        # Shuffled so that drop_last leaves out different examples every epoch
+        shuffle=True,
+        generator=torch.Generator().manual_seed(seed),
+        # Saves one CUDA graph capture for the smaller last training batch
+        drop_last=True,
+        pin_memory=True,
+        num_workers=2,
+        persistent_workers=True
     )
     val_loader = torch.utils.data.DataLoader(
         dataset=dataset['validation'],
-        batch_size=batch_size
+        batch_size=batch_size,
+        pin_memory=True,
+        num_workers=2,
+        persistent_workers=True
     )
     test_loader = torch.utils.data.DataLoader(
         dataset=dataset['test'],
-        batch_size=batch_size
+        batch_size=batch_size,
+        pin_memory=True,
+        num_workers=2,
+        persistent_workers=True
     )
     return train_loader, val_loader, test_loader